@@ -0,0 +1,232 @@
+import os
+import streamlit as st
+import pandas as pd
+from io import BytesIO
+import numpy as np
+import requests
+from concurrent.futures import ThreadPoolExecutor
+import pvlib
+from pvlib.temperature import TEMPERATURE_MODEL_PARAMETERS
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# --- Functies voor dataverwerking ---
+
+def _read_csv(source, **kwargs) -> pd.DataFrame:
+    try:
+        return pd.read_csv(source, engine='pyarrow', **kwargs)
+    except (ImportError, pd.errors.ParserError):
+        # pyarrow weigert rijen met een afwijkend aantal velden; de C-parser vult ze aan met NaN
+        if hasattr(source, 'seek'): source.seek(0)
+        return pd.read_csv(source, **kwargs)
+
+def process_energy_file(file_upload, register_type: str) -> pd.DataFrame:
+    if file_upload is None: return pd.DataFrame()
+    return _parse_energy_file(file_upload.getvalue(), file_upload.name, register_type)
+
+@st.cache_data(show_spinner=False)
+def _parse_energy_file(raw_bytes: bytes, file_name: str, register_type: str) -> pd.DataFrame:
+    try:
+        df = _read_csv(
+            BytesIO(raw_bytes), sep=';', decimal=',', dtype={'Register': 'category', 'Volume': 'float64'},
+            usecols=['Van (datum)', 'Van (tijdstip)', 'Register', 'Volume']
+        )
+        df_filtered = df.loc[df['Register'] == register_type, ['Van (datum)', 'Van (tijdstip)', 'Volume']]
+        datum = pd.to_datetime(df_filtered['Van (datum)'], dayfirst=True, cache=True)
+        tijd_codes, tijden = pd.factorize(df_filtered['Van (tijdstip)'], use_na_sentinel=False)
+        tijdstip = datum + pd.to_timedelta(pd.Index(tijden).astype(str))[tijd_codes]
+        return pd.DataFrame({'Tijdstip': tijdstip, 'Volume': df_filtered['Volume']})
+    except Exception as e:
+        st.error(f"Fout bij het verwerken van Standaard CSV '{file_name}': {e}")
+        return pd.DataFrame()
+
+_KWARTIER_OFFSETS = np.arange(1, 97) * np.timedelta64(15, 'm')
+
+def process_amr_file(file_upload) -> pd.DataFrame:
+    if file_upload is None: return pd.DataFrame()
+    return _parse_amr_file(file_upload.getvalue(), file_upload.name)
+
+@st.cache_data(show_spinner=False)
+def _parse_amr_file(raw_bytes: bytes, file_name: str) -> pd.DataFrame:
+    try:
+        value_cols = list(range(10, 10 + 96))
+        usecols = [0, 7] + value_cols
+        df = _read_csv(BytesIO(raw_bytes), sep=';', decimal=',', skiprows=4, header=None, usecols=usecols)
+        # De pyarrow-engine nummert de kolommen opnieuw; zet de oorspronkelijke posities terug
+        df.columns = usecols
+        kwt = np.flatnonzero((df[7] == 'KWT').to_numpy())
+        if kwt.size == 0:
+            st.warning(f"Geen rijen met 'KWT' in de 8e kolom gevonden in '{file_name}'.")
+            return pd.DataFrame()
+        
+        start_datetime = pd.to_datetime(df[0].iloc[kwt], format='%d%m%Y %H:%M', errors='coerce', cache=True)
+        geldig = start_datetime.notna().to_numpy()
+        
+        values = pd.Series(df.iloc[kwt[geldig], 2:].to_numpy().ravel())
+        if values.dtype == object:
+            values = values.astype('string[pyarrow]').str.replace(',', '.', regex=False)
+        volume = pd.to_numeric(values, errors='coerce').astype('float64').fillna(0)
+
+        starts = start_datetime.to_numpy()[geldig]
+        tijdstip = (starts[:, None] + _KWARTIER_OFFSETS[None, :]).ravel()
+
+        return pd.DataFrame({'Tijdstip': tijdstip, 'Volume': volume.to_numpy()})
+    except Exception as e:
+        st.error(f"Fout bij het verwerken van AMR-bestand '{file_name}': {e}")
+        return pd.DataFrame()
+
+BELPEX_PATH = "BelpexFilter.csv"
+
+def process_belpex_file() -> pd.DataFrame:
+    mtime = os.path.getmtime(BELPEX_PATH) if os.path.exists(BELPEX_PATH) else None
+    return _parse_belpex_file(BELPEX_PATH, mtime)
+
+@st.cache_data(show_spinner=False)
+def _parse_belpex_file(belpex_path: str, mtime) -> pd.DataFrame:
+    try:
+        df_belpex = _read_csv(belpex_path, sep=';', encoding='cp1252', dtype='string[pyarrow]')
+        df_belpex.columns = df_belpex.columns.str.strip()
+        df_belpex['Tijdstip_uur'] = pd.to_datetime(df_belpex['Date'], dayfirst=True)
+        numeric_text = df_belpex['Euro'].str.replace('€', '', regex=False).str.strip()
+        clean_price = pd.to_numeric(numeric_text.str.replace(',', '.', regex=False), errors='coerce').astype('float64')
+        df_belpex['BELPEX_EUR_KWH'] = clean_price / 1000
+        # Het bestand loopt aflopend; merge_asof verwacht oplopend (stabiel voor dubbele uren)
+        return df_belpex[['Tijdstip_uur', 'BELPEX_EUR_KWH']].sort_values('Tijdstip_uur', kind='stable', ignore_index=True)
+    except FileNotFoundError:
+        st.error(f"Fout: Het bestand '{belpex_path}' niet gevonden. Zorg dat het bestand lokaal of op GitHub in dezelfde map staat.")
+        return pd.DataFrame()
+    except Exception as e:
+        st.error(f"Fout bij het laden van het Belpex-bestand: {e}")
+        return pd.DataFrame()
+
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])))
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def fetch_tmy_weather(lat, lon) -> pd.DataFrame:
+    tmy_api_url = f"https://re.jrc.ec.europa.eu/api/tmy?lat={lat}&lon={lon}&outputformat=csv"
+    response = _SESSION.get(tmy_api_url, timeout=30)
+    response.raise_for_status()
+    # De parser verwacht een binaire buffer en kan het formaat niet afleiden uit een buffer
+    weather = pvlib.iotools.read_pvgis_tmy(BytesIO(response.content), pvgis_format='csv', map_variables=True)[0]
+    # TMY-maanden komen uit verschillende jaren: zet ze op één jaar voor een doorlopende tijdreeks
+    idx = weather.index
+    weather.index = pd.DatetimeIndex(pd.to_datetime(pd.DataFrame({'year': 1990, 'month': idx.month, 'day': idx.day, 'hour': idx.hour, 'minute': idx.minute}), utc=True), name=idx.name)
+    return weather.sort_index()
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def _simulate_segment(lat, lon, loss, kwp, slope, azimuth) -> pd.Series:
+    weather = fetch_tmy_weather(lat, lon)
+    location = pvlib.location.Location(latitude=lat, longitude=lon, tz='Europe/Brussels')
+    # pvlib: azimuth 180 = zuid (PVGIS-invoer: 0 = zuid), vermogens in W
+    system = pvlib.pvsystem.PVSystem(
+        surface_tilt=slope, surface_azimuth=azimuth + 180,
+        module_parameters={'pdc0': kwp * 1000, 'gamma_pdc': -0.004},
+        inverter_parameters={'pdc0': kwp * 1000},
+        temperature_model_parameters=TEMPERATURE_MODEL_PARAMETERS['sapm']['open_rack_glass_polymer'],
+        losses_parameters=dict(losses_percent=loss)
+    )
+    mc = pvlib.modelchain.ModelChain(system, location, aoi_model='physical', spectral_model='no_loss')
+    mc.run_model(weather)
+    return mc.results.ac.fillna(0)
+
+_UUR_KWARTIEREN = np.arange(4) * np.timedelta64(15, 'm')
+
+@st.cache_data
+def process_pvgis_hybrid(segments, lat, lon, loss):
+    if not segments:
+        return pd.DataFrame()
+
+    with st.spinner(f"TMY-weerdata voor locatie ({lat}, {lon}) ophalen..."):
+        try:
+            weather = fetch_tmy_weather(lat, lon)
+            st.info("Weerdata succesvol opgehaald.")
+        except requests.exceptions.RequestException as e:
+            st.error(f"Kon geen weerdata ophalen bij PVGIS na 3 pogingen: {e}")
+            return pd.DataFrame()
+        except Exception as e:
+            st.error(f"Fout bij verwerken van TMY-weerdata: {e}")
+            return pd.DataFrame()
+
+    progress_bar = st.progress(0, text="Lokale PV-simulatie starten...")
+    location = pvlib.location.Location(latitude=lat, longitude=lon, tz='Europe/Brussels')
+    total_ac_power = pd.Series(0.0, index=weather.index)
+
+    with ThreadPoolExecutor(max_workers=min(5, len(segments)), initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())) as ex:
+        futures = [ex.submit(_simulate_segment, lat, lon, loss, segment['kwp'], segment['slope'], segment['azimuth']) for segment in segments]
+        for i, (segment, future) in enumerate(zip(segments, futures)):
+            total_ac_power += future.result()
+            progress_text = f"Segment {i + 1}/{len(segments)} ({segment['kwp']} kWp) gesimuleerd..."
+            progress_bar.progress((i + 1) / len(segments), text=progress_text)
+    
+    progress_bar.empty()
+    
+    uren = total_ac_power.index.tz_convert('UTC').tz_localize(None).to_numpy()
+    tijdstip = pd.DatetimeIndex((uren[:, None] + _UUR_KWARTIEREN[None, :]).ravel()).tz_localize('UTC').tz_convert(location.tz)
+    kwh = np.repeat(total_ac_power.to_numpy() / 1000 / 4, 4)
+    return pd.DataFrame({'Tijdstip': tijdstip, 'PVGIS_kwh': kwh})
+
+def match_key(tijd: pd.Series) -> np.ndarray:
+    # Sleutel in vaste wintertijd (UTC+1): elk kwartier komt precies één keer voor, los van de DST-data van het jaar
+    if tijd.dt.tz is None:
+        # Lokale tijd; bij de wintertijd-overgang is de eerste van twee gelijke tijdstippen nog zomertijd
+        tijd = tijd.dt.tz_localize('Europe/Brussels', ambiguous=~tijd.duplicated().to_numpy(), nonexistent='shift_forward')
+    dt = tijd.dt.tz_convert('Etc/GMT-1').dt
+    return ((dt.month.to_numpy(np.int64) * 100 + dt.day.to_numpy()) * 100 + dt.hour.to_numpy()) * 100 + dt.minute.to_numpy()
+
+def combine_energy_frames(dataframes: list) -> pd.DataFrame:
+    if all(d.index.is_unique for d in dataframes):
+        return pd.concat(dataframes, axis=1, join='outer').reset_index()
+    # Dubbele tijdstippen (wintertijd-overgang) krijgen een volgnummer en worden zo 1-op-1 gekoppeld
+    uniek = [d.set_index(d.groupby(level=0).cumcount(), append=True) for d in dataframes]
+    return pd.concat(uniek, axis=1, join='outer').droplevel(1).reset_index()
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def to_excel(df: pd.DataFrame) -> bytes:
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+        df.to_excel(writer, index=False, sheet_name='Data')
+    return output.getvalue()
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def to_parquet(df: pd.DataFrame) -> bytes:
+    return df.to_parquet(index=False)
+
+def _format_datum_tijd(tijdstip: pd.Series):
+    dag = tijdstip.dt.floor('D')
+    dag_codes, dagen = pd.factorize(dag, use_na_sentinel=False)
+    tijd_codes, tijden = pd.factorize(tijdstip - dag, use_na_sentinel=False)
+    datum = pd.DatetimeIndex(dagen).strftime('%d/%m/%Y').to_numpy()[dag_codes]
+    tijd = (pd.Timestamp(0) + pd.TimedeltaIndex(tijden)).strftime('%H:%M:%S').to_numpy()[tijd_codes]
+    return datum, tijd
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def to_multi_sheet_excel(df: pd.DataFrame) -> bytes:
+    output = BytesIO()
+    van_datum, van_tijd = _format_datum_tijd(df['Date'])
+    tot_datum, tot_tijd = _format_datum_tijd(df['Date'] + pd.Timedelta(minutes=15))
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+        def transform_for_new_format(data_df, kwh_column_name, register_name):
+            if kwh_column_name not in data_df.columns or data_df[kwh_column_name].sum() == 0:
+                return None
+            sheet_df = data_df[['Date', kwh_column_name]].copy()
+            sheet_df['Van (datum)'] = van_datum
+            sheet_df['Van (tijdstip)'] = van_tijd
+            sheet_df['Tot (datum)'] = tot_datum
+            sheet_df['Tot (tijdstip)'] = tot_tijd
+            sheet_df.rename(columns={kwh_column_name: 'Volume'}, inplace=True)
+            sheet_df['Volume'] = sheet_df['Volume'].astype(str).str.replace('.', ',', regex=False)
+            sheet_df['Eenheid'] = 'KWH'
+            sheet_df['Register'] = register_name
+            final_columns = ['Van (datum)', 'Van (tijdstip)', 'Tot (datum)', 'Tot (tijdstip)', 'Volume', 'Eenheid', 'Register']
+            return sheet_df[final_columns]
+        verbruik_sheet = transform_for_new_format(df, 'import_kwh', 'afname actief')
+        if verbruik_sheet is not None: verbruik_sheet.to_excel(writer, index=False, sheet_name='Verbruik')
+        injectie_sheet = transform_for_new_format(df, 'injection_kwh', 'injectie actief')
+        if injectie_sheet is not None: injectie_sheet.to_excel(writer, index=False, sheet_name='Injectie')
+        pv_sheet = transform_for_new_format(df, 'pv_kwh', 'Hulpverbruik Actief')
+        if pv_sheet is not None: pv_sheet.to_excel(writer, index=False, sheet_name='PV_kwh')
+        pvgis_sheet = transform_for_new_format(df, 'PVGIS_kwh', 'PVGIS')
+        if pvgis_sheet is not None: pvgis_sheet.to_excel(writer, index=False, sheet_name='PVGIS_kwh')
+    return output.getvalue()